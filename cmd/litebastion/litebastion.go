@@ -27,6 +27,7 @@ import (
 	"os/signal"
 	"strings"
 	"sync"
+	"sync/atomic"
 	"syscall"
 	"time"
 
@@ -44,6 +45,12 @@ var allowedBackendsFile = flag.String("backends", "", "file of accepted key hash
 
 type keyHash [sha256.Size]byte
 
+// backendID is the request context value that identifies the target backend.
+type backendID struct {
+	name string // hex-encoded key hash, as sent by the client
+	hash keyHash
+}
+
 func main() {
 	flag.BoolVar(&http2.VerboseLogs, "h2v", false, "enable HTTP/2 verbose logs")
 	flag.Parse()
@@ -73,8 +80,7 @@ func main() {
 	if *allowedBackendsFile == "" {
 		log.Fatal("-backends is missing")
 	}
-	var allowedBackendsMu sync.RWMutex
-	var allowedBackends map[keyHash]bool
+	var allowedBackends atomic.Pointer[map[keyHash]bool]
 	reloadBackends := func() error {
 		newBackends := make(map[keyHash]bool)
 		backendsList, err := os.ReadFile(*allowedBackendsFile)
@@ -93,15 +99,13 @@ func main() {
 			h := *(*keyHash)(l)
 			newBackends[h] = true
 		}
-		allowedBackendsMu.Lock()
-		defer allowedBackendsMu.Unlock()
-		allowedBackends = newBackends
+		allowedBackends.Store(&newBackends)
 		return nil
 	}
 	if err := reloadBackends(); err != nil {
 		log.Fatalf("failed to load backends: %v", err)
 	}
-	log.Printf("loaded %d backends", len(allowedBackends))
+	log.Printf("loaded %d backends", len(*allowedBackends.Load()))
 	c := make(chan os.Signal, 1)
 	signal.Notify(c, syscall.SIGHUP)
 	go func() {
@@ -125,9 +129,7 @@ func main() {
 				return errors.New("self-signed certificate key type is not Ed25519")
 			}
 			h := sha256.Sum256(pk)
-			allowedBackendsMu.RLock()
-			defer allowedBackendsMu.RUnlock()
-			if !allowedBackends[h] {
+			if !(*allowedBackends.Load())[h] {
 				return fmt.Errorf("unrecognized backend %x", h)
 			}
 			return nil
@@ -143,7 +145,7 @@ func main() {
 		// TODO: migrate to Rewrite once Go 1.19 is unsupported.
 		/* Rewrite: func(pr *httputil.ProxyRequest) {
 			pr.Out.URL.Scheme = "https" // needed for the required :scheme header
-			pr.Out.Host = pr.In.Context().Value("backend").(string)
+			pr.Out.Host = pr.In.Context().Value("backend").(backendID).name
 			pr.SetXForwarded()
 			// We don't interpret the query, so pass it on unmodified.
 			pr.Out.URL.RawQuery = pr.In.URL.RawQuery
@@ -155,7 +157,7 @@ func main() {
 			r.Header.Del("X-Forwarded-For")
 			r.URL.Scheme = "https" // needed for the required :scheme header
 			r.Header.Set("X-Forwarded-Host", r.Host)
-			r.Host = r.Context().Value("backend").(string)
+			r.Host = r.Context().Value("backend").(backendID).name
 		},
 		Transport: p,
 	}
@@ -169,12 +171,18 @@ func main() {
 				return
 			}
 			path = path[1:]
-			kh, path, ok := strings.Cut(path, "/")
+			khHex, path, ok := strings.Cut(path, "/")
 			if !ok {
 				http.Error(w, "request must start with /KEY_HASH/", http.StatusNotFound)
 				return
 			}
-			ctx := context.WithValue(r.Context(), "backend", kh)
+			kh, err := hex.DecodeString(khHex)
+			if err != nil || len(kh) != sha256.Size {
+				http.Error(w, "invalid backend key hash", http.StatusNotFound)
+				return
+			}
+			ctx := context.WithValue(r.Context(), "backend",
+				backendID{name: khHex, hash: *(*keyHash)(kh)})
 			r = r.Clone(ctx)
 			r.URL.Path = "/" + path
 			proxy.ServeHTTP(w, r)
@@ -221,13 +229,12 @@ type backendConnectionsPool struct {
 }
 
 func (p *backendConnectionsPool) RoundTrip(r *http.Request) (*http.Response, error) {
-	kh, err := hex.DecodeString(r.Host)
-	if err != nil || len(kh) != sha256.Size {
-		// TODO: return this as a response instead.
-		return nil, errors.New("invalid backend key hash")
+	b, ok := r.Context().Value("backend").(backendID)
+	if !ok {
+		return nil, errors.New("internal error: missing backend key hash")
 	}
 	p.RLock()
-	cc, ok := p.conns[*(*keyHash)(kh)]
+	cc, ok := p.conns[b.hash]
 	p.RUnlock()
 	if !ok {
 		// TODO: return this as a response instead.
@@ -242,7 +249,8 @@ func (p *backendConnectionsPool) handleBackend(hs *http.Server, c *tls.Conn, h h
 		// Send a PING every 15s, with the default 15s timeout.
 		ReadIdleTimeout: 15 * time.Second,
 	}
-	cc, err := t.NewClientConn(c)
+	cn := &closeNotifyConn{Conn: c, closed: make(chan struct{})}
+	cc, err := t.NewClientConn(cn)
 	if err != nil {
 		log.Printf("%x: failed to convert to HTTP/2 client connection: %v", backend, err)
 		return
@@ -268,10 +276,29 @@ func (p *backendConnectionsPool) handleBackend(hs *http.Server, c *tls.Conn, h h
 
 	log.Printf("%x: accepted new backend connection", backend)
 	// We need not to return, or http.Server will close this connection. There
-	// is no way to wait for the ClientConn's closing, so we poll. We could
-	// switch this to a Server.ConnState callback with some plumbing.
-	for !cc.State().Closed {
-		time.Sleep(1 * time.Second)
-	}
+	// is no way to wait for the ClientConn's closing, but it always closes the
+	// underlying connection when it's done with it, so we wait for that.
+	<-cn.closed
 	log.Printf("%x: backend connection expired", backend)
 }
+
+// closeNotifyConn is a *tls.Conn that signals when it gets closed.
+//
+// It embeds *tls.Conn rather than net.Conn so that http2.Transport can still
+// retrieve the ConnectionState. However, http2.ClientConn can't recognize it
+// as a *tls.Conn anymore, so Close takes over the forced close of the
+// underlying connection that ClientConn would otherwise apply if the TLS
+// close_notify stalls on an unresponsive peer.
+type closeNotifyConn struct {
+	*tls.Conn
+	closeOnce sync.Once
+	closed    chan struct{}
+}
+
+func (c *closeNotifyConn) Close() error {
+	c.closeOnce.Do(func() { close(c.closed) })
+	// Match the 250ms timeout of http2.ClientConn.forceCloseConn.
+	t := time.AfterFunc(250*time.Millisecond, func() { c.Conn.NetConn().Close() })
+	defer t.Stop()
+	return c.Conn.Close()
+}
@@ -289,11 +289,11 @@ func verifySingleSignature(key, checkpoint, signature []byte) error {
 }
 
 func serializeCheckpoint(origin string, size int64, hash tlog.Hash) []byte {
-	return []byte(fmt.Sprintf("%s\n%d\n%s\n", origin, size, hash))
+	return fmt.Appendf(nil, "%s\n%d\n%s\n", origin, size, hash)
 }
 
 func serializeCosignatureSignedData(t time.Time, origin string, size int64, hash tlog.Hash) []byte {
-	return []byte(fmt.Sprintf("cosignature/v1\ntime %d\n%s\n%d\n%s\n", t.Unix(), origin, size, hash))
+	return fmt.Appendf(nil, "cosignature/v1\ntime %d\n%s\n%d\n%s\n", t.Unix(), origin, size, hash)
 }
 
 func (w *Witness) checkConsistency(origin string,